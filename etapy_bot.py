@@ -1,14 +1,27 @@
 # ────────────────────────── etapy_bot.py (2025-08 • SQLite + sticky self-heal + drop_pending) ──────────────────────────
+import io
 import os
 import re
 import json
+import hashlib
+import functools
 import sqlite3
 import logging
+import time
+import asyncio
+import threading
 import calendar as cal
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime, date, timedelta
 from typing import Dict, List, Optional
 
 from dotenv import load_dotenv
+try:  # (opcjonalnie) szybszy JSON dla stanu użytkowników
+    import orjson
+except ImportError:
+    orjson = None
+from openpyxl import Workbook
 
 from telegram import (
     Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand,
@@ -21,17 +34,27 @@ from telegram.error import BadRequest
 
 # ──────────────────── konfiguracja ────────────────────
 load_dotenv()
+log = logging.getLogger("etapy_bot")
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
 if WEBHOOK_URL and not WEBHOOK_URL.startswith(("http://", "https://")):
     WEBHOOK_URL = "https://" + WEBHOOK_URL
+# webhook = produkcja (wymaga WEBHOOK_URL); lokalnie bez publicznego adresu: RUN_MODE=polling
+RUN_MODE = os.getenv("RUN_MODE", "webhook").strip().lower()
+# nagłówek X-Telegram-Bot-Api-Secret-Token; domyślnie wyprowadzony z tokenu bota
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or (
+    hashlib.sha256(TELEGRAM_TOKEN.encode()).hexdigest() if TELEGRAM_TOKEN else None)
 PORT = int(os.getenv("PORT", 8080))
+# ile update'ów przetwarzamy równolegle (webhook odpowiada 200 od razu, reszta czeka w kolejce)
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", 256))
+# ile równoległych połączeń webhooka otwiera Telegram (1-100)
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", 40))
 DATA_DIR = os.getenv("DATA_DIR", ".")
 os.makedirs(DATA_DIR, exist_ok=True)
 
 DB_FILE = os.path.join(DATA_DIR, "invest.db")
-STATE_DIR = os.path.join(DATA_DIR, "state")
-os.makedirs(STATE_DIR, exist_ok=True)
+STATE_DB_FILE = os.path.join(DATA_DIR, "state.db")
+STATE_DIR = os.path.join(DATA_DIR, "state")  # stary zapis stanu (pliki <uid>.json) – tylko do migracji
 
 # Stałe etapy
 STAGES = [
@@ -45,222 +68,451 @@ STAGES = [
 ]
 CODE2NAME = {x["code"]: x["name"] for x in STAGES}
 NAME2CODE = {x["name"]: x["code"] for x in STAGES}
+# pole panelu → kolumna tabeli stages
+STAGE_COLS = {
+    "Percent": "percent", "ToFinish": "to_finish", "Notes": "notes", "Finished": "finished",
+    "LastUpdated": "last_updated", "LastEditor": "last_editor", "LastEditorId": "last_editor_id",
+}
+PHOTOS_MAX = 200  # ile ostatnich zdjęć trzymamy na etap
 
 DATE_PICK = 10
 
+# wzorce callback_data (ASCII) – kompilowane raz przy imporcie
+PAT_DATE_OPEN = re.compile(r"^date:open$", re.ASCII)
+PAT_CALENDAR = re.compile(r"^(?:cal:\d{4}-\d{2}|day:\d{2}\.\d{2}\.\d{4})$", re.ASCII)
+PAT_PROJECTS = re.compile(r"^(?:nav:home|proj:(?:add|arch|open:\d+|finish|toggle_active|delete|delyes|delno)|arch:(?:(?:tog|del|delyes):\d+|delno))$", re.ASCII)
+PAT_STAGE = re.compile(r"^(?:stage:(?:open:S[1-7]|set:(?:todo|notes|percent:S[1-7])|clear:(?:todo|notes):S[1-7]|save:S[1-7]|add_photo)|proj:back)$", re.ASCII)
+PAT_PERCENT = re.compile(r"^pct:(?:S[1-7]:(?:\d+|manual)|back)$", re.ASCII)
+
 # ──────────────────── helpers: czas, stan ────────────────────
-def today_str() -> str: return datetime.now().strftime("%d.%m.%Y")
-def to_ddmmyyyy(d: date) -> str: return d.strftime("%d.%m.%Y")
+# [sekunda epoki, "dd.mm.rrrr gg:mm:ss", "dd.mm.rrrr"] – formatujemy najwyżej raz na sekundę
+_TS_CACHE = [-1, "", ""]
+
+def _ts_now() -> list:
+    sec = int(time.time())
+    if sec != _TS_CACHE[0]:
+        dt = datetime.fromtimestamp(sec)
+        d = f"{dt.day:02d}.{dt.month:02d}.{dt.year}"
+        _TS_CACHE[:] = [sec, f"{d} {dt.hour:02d}:{dt.minute:02d}:{dt.second:02d}", d]
+    return _TS_CACHE
+
+def today_str() -> str: return _ts_now()[2]
+def now_ts_str() -> str: return _ts_now()[1]
+def to_ddmmyyyy(d: date) -> str: return f"{d.day:02d}.{d.month:02d}.{d.year}"
+
+def _json_loads(raw: bytes):
+    return orjson.loads(raw) if orjson else json.loads(raw.decode("utf-8"))
 
-def _state_path(uid: int) -> str:
-    return os.path.join(STATE_DIR, f"{uid}.json")
+def _json_dumps(obj) -> bytes:
+    return orjson.dumps(obj) if orjson else json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+# stan użytkowników w pamięci; tabelę user_state (state.db) czytamy tylko przy pierwszym odwołaniu (np. po restarcie)
+_STATE_MEM: Dict[int, dict] = {}
 
 def load_user_state(uid: int) -> dict:
-    path = _state_path(uid)
-    if not os.path.exists(path): return {}
-    try:
-        with open(path, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except Exception:
-        return {}
+    if uid in _STATE_MEM:
+        return dict(_STATE_MEM[uid])
+    # błędy bazy (np. locked) lecą dalej – pusty stan w cache nadpisałby przy sync_out prawdziwy wiersz
+    row = _state_conn().execute("SELECT data FROM user_state WHERE uid=?;", (uid,)).fetchone()
+    data = {}
+    if row:
+        try:
+            data = _json_loads(row[0])
+        except Exception:  # uszkodzony JSON
+            data = {}
+    _STATE_MEM[uid] = data
+    return dict(data)
 
 def save_user_state(uid: int, data: dict) -> None:
-    tmp = _state_path(uid) + ".tmp"
-    with open(tmp, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False)
-    os.replace(tmp, _state_path(uid))
+    if _STATE_MEM.get(uid) == data: return  # nic się nie zmieniło – bez zapisu do bazy
+    conn = _state_conn()
+    try:
+        conn.execute("INSERT INTO user_state(uid, data) VALUES(?, ?) ON CONFLICT(uid) DO UPDATE SET data=excluded.data;",
+                     (uid, _json_dumps(data)))
+        conn.commit()
+    except BaseException:
+        conn.rollback(); raise
+    # cache dopiero po udanym commit – po błędzie zapisu kolejny sync_out spróbuje ponownie
+    _STATE_MEM[uid] = dict(data)
+
+# klucze user_data zapisywane w user_state
+_SYNC_KEYS = ("date", "project", "stage_code", "stage_name", "await", "sticky_id")
 
 def sync_in(update_or_ctx, context: ContextTypes.DEFAULT_TYPE) -> int:
     uid = (update_or_ctx.effective_user.id if isinstance(update_or_ctx, Update)
            else update_or_ctx.callback_query.from_user.id)
     state = load_user_state(uid)
     if state:
-        for k in ["date", "project", "stage_code", "await", "sticky_id"]:
-            if k in state:
-                context.user_data[k] = state[k]
+        context.user_data.update({k: state[k] for k in _SYNC_KEYS if k in state})
     return uid
 
 def sync_out(uid: int, context: ContextTypes.DEFAULT_TYPE) -> None:
-    data = {}
-    for k in ["date", "project", "stage_code", "await", "sticky_id"]:
-        if k in context.user_data:
-            data[k] = context.user_data[k]
-    save_user_state(uid, data)
+    ud = context.user_data
+    save_user_state(uid, {k: ud[k] for k in _SYNC_KEYS if k in ud})
+
+def set_stage(context: ContextTypes.DEFAULT_TYPE, scode: str) -> None:
+    # nazwa etapu rozwiązywana raz, przy wyborze – handlery wejść czytają ją wprost z user_data
+    context.user_data["stage_code"] = scode
+    context.user_data["stage_name"] = CODE2NAME.get(scode, "")
+
+def current_stage_name(context: ContextTypes.DEFAULT_TYPE) -> str:
+    ud = context.user_data
+    return ud.get("stage_name") or CODE2NAME.get(ud.get("stage_code") or "", "")
 
 # ──────────────────── SQLite ────────────────────
+# połączenie per wątek (handlery zapisują przez asyncio.to_thread); PRAGMA ustawiane raz na połączenie
+_DB_LOCAL = threading.local()
+_DB_ALL: List[sqlite3.Connection] = []
+
 def _conn():
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    conn.execute("PRAGMA journal_mode=WAL;")
-    conn.execute("PRAGMA busy_timeout=5000;")
-    conn.execute("PRAGMA foreign_keys=ON;")
+    conn = getattr(_DB_LOCAL, "conn", None)
+    if conn is None:
+        # cache przygotowanych zapytań per połączenie (klucz = dokładny tekst SQL)
+        conn = sqlite3.connect(DB_FILE, check_same_thread=False, cached_statements=256)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL;")
+        # WAL + NORMAL: commit bez fsync, fsync zbiorczo przy checkpoincie
+        conn.execute("PRAGMA synchronous=NORMAL;")
+        # sortowania/tymczasowe tabele w RAM, ~20 MB cache stron, odczyt przez mmap (bez pread na każdą stronę)
+        conn.execute("PRAGMA temp_store=MEMORY;")
+        conn.execute("PRAGMA cache_size=-20000;")
+        conn.execute("PRAGMA mmap_size=67108864;")
+        conn.execute("PRAGMA busy_timeout=5000;")
+        conn.execute("PRAGMA foreign_keys=ON;")
+        _DB_LOCAL.conn = conn
+        _DB_ALL.append(conn)
     return conn
 
-def init_db():
+@contextmanager
+def get_conn():
+    """Połączenie wątku na czas zapisu; wyjątek = rollback, żeby niedokończona transakcja nie trzymała blokady."""
     conn = _conn()
-    cur = conn.cursor()
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS projects (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        name TEXT UNIQUE NOT NULL,
-        active INTEGER NOT NULL DEFAULT 1,
-        finished INTEGER NOT NULL DEFAULT 0,
-        created_at TEXT NOT NULL
-    );
-    """)
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS stages (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        project_id INTEGER NOT NULL REFERENCES projects(id) ON DELETE CASCADE,
-        code TEXT NOT NULL,
-        name TEXT NOT NULL,
-        percent INTEGER,
-        to_finish TEXT,
-        notes TEXT,
-        finished TEXT,
-        last_updated TEXT,
-        photos TEXT,
-        last_editor TEXT,
-        last_editor_id TEXT,
-        UNIQUE(project_id, code)
-    );
-    """)
-    conn.commit()
-    conn.close()
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback(); raise
+
+# stan rozmów w osobnym pliku z własną blokadą zapisu: sync_out na pętli zdarzeń nie czeka
+# na zapisy etapów z wątków (asyncio.to_thread); używany tylko z pętli, więc jedno połączenie
+_STATE_DB: Optional[sqlite3.Connection] = None
+
+def _state_conn():
+    global _STATE_DB
+    if _STATE_DB is None:
+        conn = sqlite3.connect(STATE_DB_FILE, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL;")
+        conn.execute("PRAGMA synchronous=NORMAL;")
+        conn.execute("PRAGMA busy_timeout=5000;")
+        conn.execute("CREATE TABLE IF NOT EXISTS user_state (uid INTEGER PRIMARY KEY, data BLOB NOT NULL);")
+        conn.commit()
+        _STATE_DB = conn
+    return _STATE_DB
+
+def close_db():
+    """Zamknięcie przy wyłączaniu aplikacji (checkpoint WAL)."""
+    global _STATE_DB
+    while _DB_ALL:
+        _DB_ALL.pop().close()
+    _DB_LOCAL.__dict__.clear()
+    if _STATE_DB is not None:
+        _STATE_DB.close(); _STATE_DB = None
+
+def init_db():
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS projects (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT UNIQUE NOT NULL,
+            active INTEGER NOT NULL DEFAULT 1,
+            finished INTEGER NOT NULL DEFAULT 0,
+            created_at TEXT NOT NULL
+        );
+        """)
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS stages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            project_id INTEGER NOT NULL REFERENCES projects(id) ON DELETE CASCADE,
+            code TEXT NOT NULL,
+            name TEXT NOT NULL,
+            percent INTEGER,
+            to_finish TEXT,
+            notes TEXT,
+            finished TEXT,
+            last_updated TEXT,
+            photos TEXT,
+            last_editor TEXT,
+            last_editor_id TEXT,
+            UNIQUE(project_id, code)
+        );
+        """)
+        # zdjęcia: wiersz na file_id (dopisanie = jeden INSERT, bez przepisywania listy)
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS stage_photos (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            stage_id INTEGER NOT NULL REFERENCES stages(id) ON DELETE CASCADE,
+            file_id TEXT NOT NULL,
+            added_at TEXT NOT NULL
+        );
+        """)
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_stage_photos_stage ON stage_photos(stage_id, id);")
+        # wyszukiwanie etapu po nazwie (update_stage, append_stage_photo) i lista inwestycji w kolejności menu
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_stages_pid_name ON stages(project_id, name);")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_projects_active_created ON projects(active DESC, created_at);")
+        # migracja: stara kolumna stages.photos (file_id rozdzielone spacją) → stage_photos
+        cur.execute("SELECT id, photos, last_updated FROM stages WHERE photos IS NOT NULL AND TRIM(photos) <> '';")
+        for r in cur.fetchall():
+            cur.executemany("INSERT INTO stage_photos(stage_id, file_id, added_at) VALUES(?, ?, ?);",
+                            [(r["id"], fid, r["last_updated"] or "") for fid in r["photos"].split()])
+            cur.execute("UPDATE stages SET photos='' WHERE id=?;", (r["id"],))
+        conn.commit()
+    # migracja stanu rozmów do state.db: tabela user_state z invest.db i stare pliki state/<uid>.json
+    sconn = _state_conn()
+    with get_conn() as conn:
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='user_state';").fetchone():
+            sconn.executemany("INSERT OR IGNORE INTO user_state(uid, data) VALUES(?, ?);",
+                              [tuple(r) for r in conn.execute("SELECT uid, data FROM user_state;")])
+            sconn.commit()
+            conn.execute("DROP TABLE user_state;"); conn.commit()
+    legacy = [fn for fn in (os.listdir(STATE_DIR) if os.path.isdir(STATE_DIR) else [])
+              if fn.endswith(".json") and fn[:-5].lstrip("-").isdigit()]
+    for fn in legacy:
+        with open(os.path.join(STATE_DIR, fn), "rb") as f:
+            sconn.execute("INSERT OR IGNORE INTO user_state(uid, data) VALUES(?, ?);", (int(fn[:-5]), f.read()))
+    sconn.commit()
+    for fn in legacy:
+        os.remove(os.path.join(STATE_DIR, fn))
+
+# cache w pamięci (lista inwestycji, etapy) + licznik zapisów: odczyt, który trwał
+# w trakcie zapisu z innego wątku, nie wkłada do cache nieaktualnych danych
+_CACHE_GEN = 0
+_PROJECTS_CACHE: Optional[List[Dict[str, str]]] = None
+
+def _invalidate_projects() -> None:
+    global _PROJECTS_CACHE, _CACHE_GEN
+    _CACHE_GEN += 1
+    _PROJECTS_CACHE = None
 
 def list_projects(active_only: bool = True) -> List[Dict[str, str]]:
-    conn = _conn(); cur = conn.cursor()
-    if active_only:
-        cur.execute("SELECT name, active, finished, created_at FROM projects WHERE active=1 ORDER BY created_at ASC;")
-    else:
+    global _PROJECTS_CACHE
+    projs = _PROJECTS_CACHE
+    if projs is None:
+        gen = _CACHE_GEN
+        cur = _conn().cursor()
         cur.execute("SELECT name, active, finished, created_at FROM projects ORDER BY active DESC, created_at ASC;")
-    out = []
-    for r in cur.fetchall():
-        out.append({
+        projs = [{
             "name": r["name"],
             "active": bool(r["active"]),
             "finished": bool(r["finished"]),
             "created": r["created_at"],
-        })
-    conn.close()
-    return out
+        } for r in cur.fetchall()]
+        if gen == _CACHE_GEN: _PROJECTS_CACHE = projs
+    if active_only:
+        return [p for p in projs if p["active"]]
+    return list(projs)
+
+# nazwa → id (nazwy są UNIQUE i nie zmieniają się); brak wpisu przy nieistniejącej inwestycji
+_PID_CACHE: Dict[str, int] = {}
 
 def _get_project_id(name: str) -> Optional[int]:
-    conn = _conn(); cur = conn.cursor()
-    cur.execute("SELECT id FROM projects WHERE name=?;", (name,))
-    row = cur.fetchone()
-    conn.close()
-    return row["id"] if row else None
+    pid = _PID_CACHE.get(name)
+    if pid is None:
+        cur = _conn().cursor()
+        cur.execute("SELECT id FROM projects WHERE name=?;", (name,))
+        row = cur.fetchone()
+        if row: pid = _PID_CACHE[name] = row["id"]
+    return pid
+
+# inwestycje, dla których komplet etapów już istnieje (id z AUTOINCREMENT nie wracają po usunięciu)
+_STAGES_READY: set = set()
+
+def _insert_default_stages(conn, pid: int) -> None:
+    # UNIQUE(project_id, code) odsiewa istniejące etapy – bez wstępnego SELECT; commit robi wołający
+    conn.executemany("""
+        INSERT OR IGNORE INTO stages (project_id, code, name, percent, to_finish, notes, finished, last_updated, photos, last_editor, last_editor_id)
+        VALUES (?, ?, ?, NULL, '', '', '-', '', '', '', '');
+    """, [(pid, st["code"], st["name"]) for st in STAGES])
 
 def _ensure_default_stages(pid: int):
-    conn = _conn(); cur = conn.cursor()
-    cur.execute("SELECT code FROM stages WHERE project_id=?;", (pid,))
-    have = {r["code"] for r in cur.fetchall()}
-    for st in STAGES:
-        if st["code"] not in have:
-            cur.execute("""
-                INSERT INTO stages (project_id, code, name, percent, to_finish, notes, finished, last_updated, photos, last_editor, last_editor_id)
-                VALUES (?, ?, ?, NULL, '', '', '-', '', '', '', '');
-            """, (pid, st["code"], st["name"]))
-    conn.commit(); conn.close()
+    if pid in _STAGES_READY: return
+    with get_conn() as conn:
+        _insert_default_stages(conn, pid)
+        conn.commit()
+    _STAGES_READY.add(pid)
 
 def add_project(name: str) -> None:
     name = name.strip()
     if not name: return
     if _get_project_id(name): return
-    conn = _conn(); cur = conn.cursor()
-    cur.execute("INSERT INTO projects(name, active, finished, created_at) VALUES(?, 1, 0, ?);", (name, datetime.now().isoformat()))
-    conn.commit(); conn.close()
-    pid = _get_project_id(name)
-    if pid: _ensure_default_stages(pid)
+    # inwestycja + komplet etapów w jednej transakcji (jeden commit)
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("INSERT INTO projects(name, active, finished, created_at) VALUES(?, 1, 0, ?);", (name, datetime.now().isoformat()))
+        pid = cur.lastrowid
+        _insert_default_stages(conn, pid)
+        conn.commit()
+    _PID_CACHE[name] = pid; _STAGES_READY.add(pid); _invalidate_projects(); _invalidate_stages(name)
 
-def set_project_active(name: str, active: bool) -> None:
-    conn = _conn(); cur = conn.cursor()
-    cur.execute("UPDATE projects SET active=? WHERE name=?;", (1 if active else 0, name))
-    conn.commit(); conn.close()
+def toggle_project_active(name: str) -> None:
+    """Archiwizuj/przywróć – flaga odwracana w samym UPDATE, bez odczytu listy inwestycji."""
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("UPDATE projects SET active=1-active WHERE name=?;", (name,))
+        conn.commit(); _invalidate_projects()
 
 def set_project_finished(name: str, finished: bool) -> None:
-    conn = _conn(); cur = conn.cursor()
-    cur.execute("UPDATE projects SET finished=? WHERE name=?;", (1 if finished else 0, name))
-    conn.commit(); conn.close()
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("UPDATE projects SET finished=? WHERE name=?;", (1 if finished else 0, name))
+        conn.commit(); _invalidate_projects()
 
 def delete_project(name: str) -> None:
-    conn = _conn(); cur = conn.cursor()
-    cur.execute("DELETE FROM projects WHERE name=?;", (name,))
-    conn.commit(); conn.close()
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM projects WHERE name=?;", (name,))
+        conn.commit(); _PID_CACHE.pop(name, None); _invalidate_projects(); _invalidate_stages(name)
+
+# odczyt tylko kolumn potrzebnych do _stage_from_row (bez id/project_id/code)
+_STAGE_SELECT = ("SELECT name, " + ", ".join(STAGE_COLS.values())
+                 + ", (SELECT COUNT(*) FROM stage_photos p WHERE p.stage_id = stages.id) FROM stages")
+_STAGES_BY_PROJECT_SQL = f"{_STAGE_SELECT} WHERE project_id=?;"
+
+def _stage_from_row(r) -> Dict[str, str]:
+    # pozycyjnie (kolejność jak w _STAGE_SELECT) – bez wyszukiwania kolumn po nazwie
+    raw = dict(zip(STAGE_COLS, r[1:]))
+    out = {"Stage": r[0], **{k: v or "" for k, v in raw.items()}}
+    out["Percent"] = "" if raw["Percent"] is None else raw["Percent"]
+    out["Finished"] = raw["Finished"] or "-"
+    out["PhotoCount"] = r[-1]
+    return out
 
-def read_stage(project: str, stage_name: str) -> Dict[str, str]:
+def _empty_stage(stage_name: str) -> Dict[str, str]:
+    out = {"Stage": stage_name, **{k: "" for k in STAGE_COLS}}
+    out["Finished"] = "-"
+    out["PhotoCount"] = 0
+    return out
+
+# etapy per inwestycja w pamięci; każdy zapis etapów/zdjęć woła _invalidate_stages(projekt)
+_STAGES_CACHE: Dict[str, Dict[str, Dict[str, str]]] = {}
+
+def _invalidate_stages(project: str) -> None:
+    global _CACHE_GEN
+    _CACHE_GEN += 1
+    _STAGES_CACHE.pop(project, None)
+
+def read_all_stages(project: str) -> Dict[str, Dict[str, str]]:
+    """Wszystkie etapy inwestycji jednym zapytaniem (klucz: nazwa etapu). Wynik współdzielony – tylko do odczytu."""
+    cached = _STAGES_CACHE.get(project)  # jeden odczyt – wpis może zniknąć w trakcie (inwalidacja z wątku zapisu)
+    if cached is not None:
+        return cached
+    gen = _CACHE_GEN
     pid = _get_project_id(project)
-    if not pid:
-        add_project(project)
-        pid = _get_project_id(project)
-    _ensure_default_stages(pid)
-    conn = _conn(); cur = conn.cursor()
-    cur.execute("SELECT * FROM stages WHERE project_id=? AND name=?;", (pid, stage_name))
-    r = cur.fetchone()
-    if not r:
-        code = NAME2CODE.get(stage_name, "S?")
-        cur.execute("""
-            INSERT INTO stages (project_id, code, name, percent, to_finish, notes, finished, last_updated, photos, last_editor, last_editor_id)
-            VALUES (?, ?, ?, NULL, '', '', '-', '', '', '', '');
-        """, (pid, code, stage_name))
-        conn.commit()
-        cur.execute("SELECT * FROM stages WHERE project_id=? AND name=?;", (pid, stage_name))
-        r = cur.fetchone()
-    conn.close()
-    return {
-        "Stage": r["name"],
-        "Percent": ("" if r["percent"] is None else r["percent"]),
-        "ToFinish": r["to_finish"] or "",
-        "Notes": r["notes"] or "",
-        "Finished": r["finished"] or "-",
-        "LastUpdated": r["last_updated"] or "",
-        "Photos": r["photos"] or "",
-        "LastEditor": r["last_editor"] or "",
-        "LastEditorId": r["last_editor_id"] or "",
-    }
+    out = {}
+    if pid:
+        cur = _conn().cursor()
+        cur.execute(_STAGES_BY_PROJECT_SQL, (pid,))
+        out = {r[0]: _stage_from_row(r) for r in cur.fetchall()}
+    if gen == _CACHE_GEN: _STAGES_CACHE[project] = out
+    return out
 
-def update_stage(project: str, stage_name: str, updates: Dict[str, str], editor_name: str, editor_id: int) -> None:
+def read_stage(project: str, stage_name: str) -> Dict[str, str]:
+    """Czysty odczyt z cache read_all_stages – bez INSERT/commit. Brakujące wiersze zakłada dopiero update_stage."""
+    return read_all_stages(project).get(stage_name) or _empty_stage(stage_name)
+
+@functools.lru_cache(maxsize=32)
+def _update_stage_sql(keys: tuple) -> str:
+    # zestawów pól jest kilka (ToFinish / Notes / Percent / samo „dotknięcie” przy zdjęciu) – SQL składany raz na zestaw
+    sets = [f"{STAGE_COLS[k]}=?" for k in keys] + ["last_updated=?", "last_editor=?", "last_editor_id=?"]
+    return f"UPDATE stages SET {', '.join(sets)} WHERE project_id=? AND name=?;"
+
+def _stage_project_id(project: str) -> int:
+    # id inwestycji do zapisu etapu; brakującą inwestycję / etapy zakłada (osobne, jednorazowe commity)
     pid = _get_project_id(project)
     if not pid:
         add_project(project); pid = _get_project_id(project)
     _ensure_default_stages(pid)
-    colmap = {
-        "Percent": "percent", "ToFinish": "to_finish", "Notes": "notes", "Finished": "finished",
-        "LastUpdated": "last_updated", "Photos": "photos", "LastEditor": "last_editor", "LastEditorId": "last_editor_id",
-    }
-    sets, vals = [], []
-    for k, v in updates.items():
-        if k not in colmap: raise ValueError(f"Unsupported field: {k}")
-        sets.append(f"{colmap[k]}=?"); vals.append(v)
-    sets.extend(["last_updated=?", "last_editor=?", "last_editor_id=?"])
-    vals.extend([datetime.now().strftime("%d.%m.%Y %H:%M:%S"), editor_name or "", str(editor_id or "")])
-    vals.extend([pid, stage_name])
-    sql = f"UPDATE stages SET {', '.join(sets)} WHERE project_id=? AND name=?;"
-    conn = _conn(); cur = conn.cursor()
-    cur.execute(sql, tuple(vals))
+    return pid
+
+def _write_stage(cur, pid: int, stage_name: str, updates: Dict[str, str], editor_name: str, editor_id: int) -> None:
+    # UPDATE (albo INSERT, gdy wiersza brak) bez commit – transakcję zamyka wołający
+    keys = tuple(updates)
+    for k in keys:
+        if k not in STAGE_COLS: raise ValueError(f"Unsupported field: {k}")
+    ts = now_ts_str(); editor = editor_name or ""; eid = str(editor_id or "")
+    cur.execute(_update_stage_sql(keys), (*updates.values(), ts, editor, eid, pid, stage_name))
     if cur.rowcount == 0:
         code = NAME2CODE.get(stage_name, "S?")
         fields = {"percent": None, "to_finish": "", "notes": "", "finished": "-",
-                  "last_updated": datetime.now().strftime("%d.%m.%Y %H:%M:%S"),
-                  "photos": "", "last_editor": editor_name or "", "last_editor_id": str(editor_id or "")}
+                  "last_updated": ts, "photos": "", "last_editor": editor, "last_editor_id": eid}
         for k, v in updates.items():
-            fields[colmap[k]] = v
+            fields[STAGE_COLS[k]] = v
         cur.execute("""
             INSERT INTO stages(project_id, code, name, percent, to_finish, notes, finished, last_updated, photos, last_editor, last_editor_id)
             VALUES(?,?,?,?,?,?,?,?,?,?,?);
         """, (pid, code, stage_name, fields["percent"], fields["to_finish"], fields["notes"], fields["finished"],
               fields["last_updated"], fields["photos"], fields["last_editor"], fields["last_editor_id"]))
-    conn.commit(); conn.close()
 
-def _percent_preview_for_project(project: str) -> str:
-    pid = _get_project_id(project)
-    if not pid: return "-"
-    conn = _conn(); cur = conn.cursor()
-    cur.execute("SELECT name, percent FROM stages WHERE project_id=?;", (pid,))
-    rows = {r["name"]: ("-" if r["percent"] is None else (f"{int(r['percent'])}%" if str(r["percent"]).isdigit() else str(r["percent"]))) for r in cur.fetchall()}
-    conn.close()
-    return " | ".join(f"{st['name'].split()[-1]} {rows.get(st['name'], '-')}" for st in STAGES)
+def update_stage(project: str, stage_name: str, updates: Dict[str, str], editor_name: str, editor_id: int) -> None:
+    pid = _stage_project_id(project)
+    with get_conn() as conn:
+        _write_stage(conn.cursor(), pid, stage_name, updates, editor_name, editor_id)
+        conn.commit(); _invalidate_stages(project)
+
+def append_stage_photo(project: str, stage_name: str, file_id: str, editor_name: str, editor_id: int) -> None:
+    """Dopisuje zdjęcie do etapu (bez odczytu listy) i przycina do PHOTOS_MAX najnowszych – jeden commit."""
+    pid = _stage_project_id(project)
+    with get_conn() as conn:
+        cur = conn.cursor()
+        _write_stage(cur, pid, stage_name, {}, editor_name, editor_id)
+        cur.execute("SELECT id FROM stages WHERE project_id=? AND name=?;", (pid, stage_name))
+        sid = cur.fetchone()["id"]
+        cur.execute("INSERT INTO stage_photos(stage_id, file_id, added_at) VALUES(?, ?, ?);", (sid, file_id, now_ts_str()))
+        # granica = id zdjęcia PHOTOS_MAX+1 od końca (jeden skok po indeksie); poniżej limitu podzapytanie daje NULL i nic nie jest kasowane
+        cur.execute("""
+            DELETE FROM stage_photos WHERE stage_id=? AND id <=
+                (SELECT id FROM stage_photos WHERE stage_id=? ORDER BY id DESC LIMIT 1 OFFSET ?);
+        """, (sid, sid, PHOTOS_MAX))
+        conn.commit(); _invalidate_stages(project)
+
+# "Etap 3" → "3" (skróty w podglądzie postępu)
+_STAGE_SHORT = {st["name"]: st["name"].split()[-1] for st in STAGES}
+
+def _percent_preview(stages: Dict[str, Dict[str, str]]) -> str:
+    # kolumna percent ma typ INTEGER – z bazy przychodzi int albo "" (NULL)
+    def fmt(name):
+        p = (stages.get(name) or {}).get("Percent", "")
+        return "-" if p == "" else (f"{p}%" if isinstance(p, int) else str(p))
+    return " | ".join(f"{short} {fmt(name)}" for name, short in _STAGE_SHORT.items())
+
+# ──────────────────── eksport xlsx ────────────────────
+EXPORT_PROJECT_HEADERS = ["Inwestycja", "Aktywna", "Zakończona", "Utworzono"]
+EXPORT_STAGE_HEADERS = ["Inwestycja", "Etap", "% ukończenia", "Do dokończenia", "Notatki", "Zakończono",
+                        "Ostatnia zmiana", "Zdjęcia", "Ostatnio edytował"]
+
+def export_xlsx() -> io.BytesIO:
+    """Zrzut bazy do xlsx (tylko eksport – źródłem prawdy pozostaje SQLite).
+    write_only: wiersze idą strumieniowo do pliku, bez budowania obiektów komórek w pamięci."""
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Inwestycje")
+    ws.append(EXPORT_PROJECT_HEADERS)
+    for p in list_projects(active_only=False):
+        ws.append([p["name"], "tak" if p["active"] else "nie", "tak" if p["finished"] else "nie", p["created"]])
+    ws = wb.create_sheet("Etapy")
+    ws.append(EXPORT_STAGE_HEADERS)
+    cur = _conn().cursor()
+    cur.execute("""
+        SELECT p.name, s.name, s.percent, s.to_finish, s.notes, s.finished, s.last_updated,
+               (SELECT COUNT(*) FROM stage_photos ph WHERE ph.stage_id = s.id), s.last_editor
+        FROM stages s JOIN projects p ON p.id = s.project_id
+        ORDER BY p.active DESC, p.created_at ASC, s.code ASC;
+    """)
+    # kolejność kolumn = EXPORT_STAGE_HEADERS; kursor iterowany bez fetchall()
+    for project, name, percent, to_finish, notes, finished, last_updated, photo_count, last_editor in cur:
+        ws.append([project, name, percent, to_finish or "", notes or "", finished or "-",
+                   last_updated or "", photo_count, last_editor or ""])
+    buf = io.BytesIO()
+    wb.save(buf); buf.seek(0)
+    return buf
 
 # ──────────────────── UI helpers ────────────────────
 async def safe_answer(q, text: Optional[str] = None, show_alert: bool = False):
@@ -272,29 +524,96 @@ async def safe_answer(q, text: Optional[str] = None, show_alert: bool = False):
     except Exception:
         pass
 
+# zadania „odpal i zapomnij” (np. kasowanie wiadomości) – trzymamy referencje, by GC ich nie przerwał
+_BG_TASKS: set = set()
+
+async def _quiet(aw) -> None:
+    try: await aw
+    except Exception as e: log.debug("background call failed: %s", e)
+
+def fire_and_forget(aw) -> None:
+    """Wywołanie Bot API poza ścieżką krytyczną – render nie czeka na jego wynik."""
+    t = asyncio.create_task(_quiet(aw))
+    _BG_TASKS.add(t); t.add_done_callback(_BG_TASKS.discard)
+
+# callbacki w trakcie obsługi (uid, data) + ostatnie id zapytań (ponowienia Telegrama)
+_INFLIGHT: set = set()
+_SEEN_QUERY_IDS: "OrderedDict[str, None]" = OrderedDict()
+SEEN_QUERY_IDS_MAX = 1024
+
+def dedup_callback(handler):
+    """Podwójne kliknięcie / ponowiony callback nie uruchamia drugi raz tej samej obsługi."""
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        q = update.callback_query
+        if q.id in _SEEN_QUERY_IDS:
+            return
+        _SEEN_QUERY_IDS[q.id] = None
+        if len(_SEEN_QUERY_IDS) > SEEN_QUERY_IDS_MAX:
+            _SEEN_QUERY_IDS.popitem(last=False)
+        key = (q.from_user.id, q.data)
+        if key in _INFLIGHT:
+            await safe_answer(q); return
+        _INFLIGHT.add(key)
+        try:
+            return await handler(update, context)
+        finally:
+            _INFLIGHT.discard(key)
+    return wrapper
+
+# jeden update naraz na użytkownika (concurrent_updates): sync_in → zmiany → sync_out tego samego
+# użytkownika się nie przeplatają, różni użytkownicy dalej idą równolegle
+# uid → [lock, liczba handlerów trzymających/czekających]; wpis znika, gdy licznik spadnie do zera
+_USER_LOCKS: Dict[int, list] = {}
+
+def per_user(handler):
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        user = update.effective_user
+        if user is None:
+            return await handler(update, context)
+        entry = _USER_LOCKS.get(user.id)
+        if entry is None:
+            entry = _USER_LOCKS[user.id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                return await handler(update, context)
+        finally:
+            entry[1] -= 1
+            if not entry[1]: del _USER_LOCKS[user.id]
+    return wrapper
+
 async def _clear_sticky_id(uid: int, context: ContextTypes.DEFAULT_TYPE):
     """Czyści nieaktualne sticky_id z pamięci trwałej i RAM."""
     context.user_data.pop("sticky_id", None)
-    st = load_user_state(uid) or {}
-    st.pop("sticky_id", None)
-    save_user_state(uid, st)
+    context.user_data.pop("sticky_hash", None)
+    sync_out(uid, context)
 
 async def sticky_set(update_or_ctx, context: ContextTypes.DEFAULT_TYPE, text: str, reply_markup: Optional[InlineKeyboardMarkup] = None):
-    """Edycja istniejącego panelu. Gdy to niemożliwe (stare sticky), czyści id i wysyła nowy."""
+    """Edycja istniejącego panelu. Gdy to niemożliwe (stare sticky), czyści id i wysyła nowy.
+    Klik w sam panel z identyczną treścią + klawiaturą jak przy ostatnim renderze → brak wywołania API."""
     chat = update_or_ctx.effective_chat if isinstance(update_or_ctx, Update) else update_or_ctx.callback_query.message.chat
     chat_id = chat.id
     uid = (update_or_ctx.effective_user.id if isinstance(update_or_ctx, Update) else update_or_ctx.callback_query.from_user.id)
     sticky_id = context.user_data.get("sticky_id")
+    h = hashlib.blake2b((text + repr(reply_markup.to_dict() if reply_markup else None)).encode(), digest_size=16).digest()
     if sticky_id:
+        # skrót tylko dla callbacku z samego panelu (wiadomość na pewno istnieje); komendy i tekst
+        # zawsze idą przez edycję, żeby po usunięciu panelu zadziałał self-heal
+        q = update_or_ctx.callback_query
+        if q and q.message and q.message.message_id == sticky_id and context.user_data.get("sticky_hash") == h:
+            return
         try:
             await context.bot.edit_message_text(
                 chat_id=chat_id, message_id=sticky_id, text=text,
                 reply_markup=reply_markup, disable_web_page_preview=True
             )
+            context.user_data["sticky_hash"] = h
             return
         except BadRequest as e:
             emsg = str(e).lower()
-            logging.info(f"editMessageText failed: {e}")
+            log.info("editMessageText failed: %s", e)
             # znane przypadki po „wyczyszczeniu chatu”
             if any(s in emsg for s in [
                 "message to edit not found",
@@ -304,24 +623,26 @@ async def sticky_set(update_or_ctx, context: ContextTypes.DEFAULT_TYPE, text: st
             ]):
                 await _clear_sticky_id(uid, context)
             elif "message is not modified" in emsg:
+                context.user_data["sticky_hash"] = h
                 return
             # dla innych błędów – spróbuj wysłać nową
         except Exception as e:
-            logging.info(f"editMessageText exception: {e}")
+            log.info("editMessageText exception: %s", e)
     # brak/wyczyszczone sticky: wyślij nowy panel i zapisz id
     m = await context.bot.send_message(chat_id, text, reply_markup=reply_markup, disable_web_page_preview=True)
     context.user_data["sticky_id"] = m.message_id
+    context.user_data["sticky_hash"] = h
     sync_out(uid, context)
 
+_AWAIT_NAMES = {"project_name": "Nazwa inwestycji", "todo": "Do dokończenia", "notes": "Notatki", "percent": "% ukończenia", "photo": "Zdjęcie"}
+
 def banner_await(context: ContextTypes.DEFAULT_TYPE) -> str:
     aw = context.user_data.get("await") or {}
     if not aw: return ""
-    names = {"project_name": "Nazwa inwestycji", "todo": "Do dokończenia", "notes": "Notatki", "percent": "% ukończenia", "photo": "Zdjęcie"}
     proj = context.user_data.get("project") or ""
-    scode = context.user_data.get("stage_code") or ""
-    sname = CODE2NAME.get(scode, "")
+    sname = current_stage_name(context)
     where = f" (inwestycja: {proj}" + (f" | {sname}" if sname else "") + ")"
-    return f"✍️ Oczekuję na: {names.get(aw.get('field'), aw.get('field'))}{where}. Wyślij teraz.\n"
+    return f"✍️ Oczekuję na: {_AWAIT_NAMES.get(aw.get('field'), aw.get('field'))}{where}. Wyślij teraz.\n"
 
 def projects_menu_text(context: ContextTypes.DEFAULT_TYPE) -> str:
     ds = context.user_data.get("date", today_str())
@@ -333,17 +654,27 @@ def projects_menu_text(context: ContextTypes.DEFAULT_TYPE) -> str:
         out.append("Brak inwestycji. Dodaj pierwszą 👇")
     return "\n".join(out)
 
+# stałe wiersze/klawiatury – budowane raz przy imporcie (obiekty PTB są niemutowalne)
+_ADD_PROJECT_ROW = {
+    on: [InlineKeyboardButton(f"{'●' if on else '○'} ➕ Dodaj inwestycję", callback_data="proj:add")]
+    for on in (False, True)
+}
+_ARCHIVE_ROW = [InlineKeyboardButton("🗄 Archiwum", callback_data="proj:arch")]
+
 def projects_menu_kb(context: ContextTypes.DEFAULT_TYPE) -> InlineKeyboardMarkup:
     ds = context.user_data.get("date", today_str())
-    projs = list_projects(active_only=True)
     aw = context.user_data.get("await") or {}
     adding = (aw.get("mode") == "text" and aw.get("field") == "project_name")
-    def mark(lbl, on): return f"{'●' if on else '○'} {lbl}"
+    return _projects_menu_kb(ds, adding, tuple(p["name"] for p in list_projects(active_only=True)))
+
+@functools.lru_cache(maxsize=32)
+def _projects_menu_kb(ds: str, adding: bool, names: tuple) -> InlineKeyboardMarkup:
+    # nazwy są w kluczu – po dodaniu/archiwizacji inwestycji klucz się zmienia, bez jawnej inwalidacji
     rows = [[InlineKeyboardButton(f"📅 Data: {ds}", callback_data="date:open")]]
-    for i, p in enumerate(projs):
-        rows.append([InlineKeyboardButton(f"🏗️ {p['name']}", callback_data=f"proj:open:{i}")])
-    rows.append([InlineKeyboardButton(mark("➕ Dodaj inwestycję", adding), callback_data="proj:add")])
-    rows.append([InlineKeyboardButton("🗄 Archiwum", callback_data="proj:arch")])
+    for i, name in enumerate(names):
+        rows.append([InlineKeyboardButton(f"🏗️ {name}", callback_data=f"proj:open:{i}")])
+    rows.append(_ADD_PROJECT_ROW[adding])
+    rows.append(_ARCHIVE_ROW)
     return InlineKeyboardMarkup(rows)
 
 def project_panel_text(context: ContextTypes.DEFAULT_TYPE) -> str:
@@ -352,39 +683,41 @@ def project_panel_text(context: ContextTypes.DEFAULT_TYPE) -> str:
     b = banner_await(context)
     if b: out.append(b)
     out.append(f"🏗️ {proj}")
-    out.append(f"📊 Postęp etapów: {_percent_preview_for_project(proj)}\n")
+    stages = read_all_stages(proj)
+    out.append(f"📊 Postęp etapów: {_percent_preview(stages)}\n")
     out.append("👇 Wybierz etap. Otwarte zadania:")
     for st in STAGES:
-        data = read_stage(proj, st["name"])
+        data = stages.get(st["name"])
+        if not data: continue
         tf = (data["ToFinish"] or "").strip()
         p = data["Percent"]
-        ptxt = f" (📊 {int(p)}%)" if str(p).isdigit() else ""
+        ptxt = f" (📊 {p}%)" if isinstance(p, int) else ""
         if tf:
             prev = tf if len(tf) <= 60 else tf[:57] + "…"
             out.append(f"• {st['name']}{ptxt}: 🔧 {prev}")
     out.append("\n⚠️ Usunięcie inwestycji jest nieodwracalne.")
     return "\n".join(out)
 
+_PROJECT_PANEL_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Etap 1", callback_data="stage:open:S1"),
+     InlineKeyboardButton("Etap 2", callback_data="stage:open:S2")],
+    [InlineKeyboardButton("Etap 3", callback_data="stage:open:S3"),
+     InlineKeyboardButton("Etap 4", callback_data="stage:open:S4")],
+    [InlineKeyboardButton("Etap 5", callback_data="stage:open:S5"),
+     InlineKeyboardButton("Etap 6", callback_data="stage:open:S6")],
+    [InlineKeyboardButton("Prace dodatkowe", callback_data="stage:open:S7")],
+    [InlineKeyboardButton("✅ Oznacz zakończoną", callback_data="proj:finish"),
+     InlineKeyboardButton("📦 Archiwizuj/Przywróć", callback_data="proj:toggle_active")],
+    [InlineKeyboardButton("🗑 Usuń inwestycję", callback_data="proj:delete")],
+    [InlineKeyboardButton("↩️ Wstecz", callback_data="nav:home")],
+])
+
 def project_panel_kb(context: ContextTypes.DEFAULT_TYPE) -> InlineKeyboardMarkup:
-    rows = [
-        [InlineKeyboardButton("Etap 1", callback_data="stage:open:S1"),
-         InlineKeyboardButton("Etap 2", callback_data="stage:open:S2")],
-        [InlineKeyboardButton("Etap 3", callback_data="stage:open:S3"),
-         InlineKeyboardButton("Etap 4", callback_data="stage:open:S4")],
-        [InlineKeyboardButton("Etap 5", callback_data="stage:open:S5"),
-         InlineKeyboardButton("Etap 6", callback_data="stage:open:S6")],
-        [InlineKeyboardButton("Prace dodatkowe", callback_data="stage:open:S7")],
-        [InlineKeyboardButton("✅ Oznacz zakończoną", callback_data="proj:finish"),
-         InlineKeyboardButton("📦 Archiwizuj/Przywróć", callback_data="proj:toggle_active")],
-        [InlineKeyboardButton("🗑 Usuń inwestycję", callback_data="proj:delete")],
-        [InlineKeyboardButton("↩️ Wstecz", callback_data="nav:home")],
-    ]
-    return InlineKeyboardMarkup(rows)
+    return _PROJECT_PANEL_KB
 
 def stage_panel_text(context: ContextTypes.DEFAULT_TYPE) -> str:
     proj = context.user_data.get("project")
-    scode = context.user_data.get("stage_code")
-    sname = CODE2NAME.get(scode, "")
+    sname = current_stage_name(context)
     data = read_stage(proj, sname)
     out = []
     b = banner_await(context)
@@ -395,7 +728,7 @@ def stage_panel_text(context: ContextTypes.DEFAULT_TYPE) -> str:
         f"📊 % ukończenia: {data['Percent'] if data['Percent'] != '' else '-'}",
         f"🔧 Do dokończenia:\n{data['ToFinish'] or '-'}",
         f"📝 Notatki:\n{data['Notes'] or '-'}",
-        f"🖼 Zdjęcia: {len((data['Photos'] or '').split()) if (data['Photos'] or '').strip() else 0}",
+        f"🖼 Zdjęcia: {data['PhotoCount']}",
         f"⏱ Ostatnia zmiana: {data['LastUpdated'] or '-'}  |  👤 {data['LastEditor'] or '-'}",
         "",
         "Wybierz działanie poniżej 👇",
@@ -408,7 +741,11 @@ def stage_panel_kb(context: ContextTypes.DEFAULT_TYPE) -> InlineKeyboardMarkup:
     if aw:
         if aw.get("mode") == "text" and aw.get("field") in {"todo", "notes", "percent"}: active_key = aw.get("field")
         if aw.get("mode") == "photo": active_key = "photo"
-    scode = context.user_data.get("stage_code", "")
+    return _stage_panel_kb(context.user_data.get("stage_code", ""), active_key)
+
+@functools.lru_cache(maxsize=64)
+def _stage_panel_kb(scode: str, active_key: Optional[str]) -> InlineKeyboardMarkup:
+    # 7 etapów × 5 stanów kropek – komplet mieści się w cache
     def mark(lbl, key): return f"{'●' if active_key == key else '○'} {lbl}"
     rows = [
         [InlineKeyboardButton(mark("🔧 Do dokończenia", "todo"), callback_data="stage:set:todo"),
@@ -422,6 +759,7 @@ def stage_panel_kb(context: ContextTypes.DEFAULT_TYPE) -> InlineKeyboardMarkup:
     ]
     return InlineKeyboardMarkup(rows)
 
+@functools.lru_cache(maxsize=8)
 def percent_kb(stage_code: str) -> InlineKeyboardMarkup:
     rows = [
         [InlineKeyboardButton("0%", callback_data=f"pct:{stage_code}:0"),
@@ -436,6 +774,11 @@ def percent_kb(stage_code: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(rows)
 
 def month_kb(year: int, month: int) -> InlineKeyboardMarkup:
+    # przycisk „Dziś” zależy od daty, więc jest częścią klucza cache
+    return _month_kb(year, month, today_str())
+
+@functools.lru_cache(maxsize=24)
+def _month_kb(year: int, month: int, today: str) -> InlineKeyboardMarkup:
     month_name = cal.month_name[month]; days = cal.monthcalendar(year, month)
     rows = [[InlineKeyboardButton(f"{month_name} {year}", callback_data="noop")]]
     rows.append([InlineKeyboardButton(x, callback_data="noop") for x in ["Pn","Wt","Śr","Cz","Pt","So","Nd"]])
@@ -451,7 +794,7 @@ def month_kb(year: int, month: int) -> InlineKeyboardMarkup:
     next_month = (date(year, month, cal.monthrange(year, month)[1]) + timedelta(days=1))
     rows.append([
         InlineKeyboardButton("« Poprzedni", callback_data=f"cal:{prev_month.year}-{prev_month.month:02d}"),
-        InlineKeyboardButton("Dziś", callback_data=f"day:{today_str()}"),
+        InlineKeyboardButton("Dziś", callback_data=f"day:{today}"),
         InlineKeyboardButton("Następny »", callback_data=f"cal:{next_month.year}-{next_month.month:02d}"),
     ])
     rows.append([InlineKeyboardButton("↩️ Wstecz", callback_data="nav:home")])
@@ -471,6 +814,7 @@ async def render_stage(update_or_ctx, context: ContextTypes.DEFAULT_TYPE):
     await sticky_set(update_or_ctx, context, stage_panel_text(context), stage_panel_kb(context))
 
 # ──────────────────── Handlers ────────────────────
+@per_user
 async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = sync_in(update, context)
     # ⬇⬇⬇ NIE przenosimy sticky_id po /start — zawsze od świeżej wiadomości
@@ -479,6 +823,7 @@ async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     sync_out(uid, context)
     await render_home(update, context)
 
+@per_user
 async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = sync_in(update, context); sync_out(uid, context)
     text = (
@@ -487,10 +832,19 @@ async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "• W projekcie → Etap → edytuj pola. Zmiany zapisują się do SQLite i od razu je widać w panelu.\n"
         "• Kropki ○/● pokazują, że czekam na tekst/zdjęcie.\n"
         "• Sticky panel sam się naprawia po wyczyszczeniu chatu.\n"
+        "• /export – pobierz wszystkie inwestycje jako plik Excel.\n"
     )
     await sticky_set(update, context, text, InlineKeyboardMarkup([[InlineKeyboardButton("↩️ Wstecz", callback_data="nav:home")]]))
 
+@per_user
+async def export_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = sync_in(update, context); sync_out(uid, context)
+    fire_and_forget(update.message.delete())
+    buf = await asyncio.to_thread(export_xlsx)  # serializacja xlsx poza pętlą zdarzeń
+    await update.effective_chat.send_document(document=buf, filename=f"inwestycje_{datetime.now():%Y-%m-%d}.xlsx")
+
 # --- data ---
+@per_user
 async def date_open_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = sync_in(update, context); await safe_answer(update.callback_query)
     now = datetime.now()
@@ -498,6 +852,7 @@ async def date_open_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     sync_out(uid, context)
     return DATE_PICK
 
+@per_user
 async def calendar_nav_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = sync_in(update, context); q = update.callback_query; await safe_answer(q); data = q.data
     if data.startswith("cal:"):
@@ -522,6 +877,8 @@ def _render_archive_kb(context: ContextTypes.DEFAULT_TYPE) -> InlineKeyboardMark
     rows.append([InlineKeyboardButton("↩️ Wstecz", callback_data="nav:home")])
     return InlineKeyboardMarkup(rows)
 
+@dedup_callback
+@per_user
 async def projects_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = sync_in(update, context); q = update.callback_query; await safe_answer(q); data = q.data
 
@@ -537,10 +894,7 @@ async def projects_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if data.startswith("arch:tog:"):
         idx = int(data.split(":")[2]); names = context.user_data.get("arch_names", [])
-        if 0 <= idx < len(names):
-            allp = {p["name"]: p for p in list_projects(active_only=False)}
-            cur = allp.get(names[idx])
-            if cur: set_project_active(names[idx], not cur["active"])
+        if 0 <= idx < len(names): await asyncio.to_thread(toggle_project_active, names[idx])
         await sticky_set(update, context, "🗄 Archiwum / Aktywne (kliknij, aby przełączyć lub usuń 🗑):", _render_archive_kb(context)); sync_out(uid, context); return
 
     if data.startswith("arch:del:"):
@@ -558,9 +912,9 @@ async def projects_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
         idx = int(data.split(":")[2]); names = context.user_data.get("arch_names", [])
         name = names[idx] if 0 <= idx < len(names) else None
         if name:
-            delete_project(name)
+            await asyncio.to_thread(delete_project, name)
             if context.user_data.get("project") == name:
-                for k in ("project", "stage_code", "await"):
+                for k in ("project", "stage_code", "stage_name", "await"):
                     context.user_data.pop(k, None)
         await sticky_set(update, context, "✅ Usunięto. Wybierz kolejne:", _render_archive_kb(context)); sync_out(uid, context); return
 
@@ -579,16 +933,13 @@ async def projects_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if data == "proj:finish":
         proj = context.user_data.get("project")
         if not proj: sync_out(uid, context); await render_home(update, context); return
-        set_project_finished(proj, True)
+        await asyncio.to_thread(set_project_finished, proj, True)
         await sticky_set(update, context, f"🎉 {proj} oznaczono jako zakończoną. 💪", InlineKeyboardMarkup([[InlineKeyboardButton("↩️ Wróć", callback_data="nav:home")]]))
         sync_out(uid, context); return
 
     if data == "proj:toggle_active":
         proj = context.user_data.get("project")
-        if proj:
-            allp = {p["name"]: p for p in list_projects(active_only=False)}
-            cur = allp.get(proj)
-            if cur: set_project_active(proj, not cur["active"])
+        if proj: await asyncio.to_thread(toggle_project_active, proj)
         sync_out(uid, context); await render_home(update, context); return
 
     if data == "proj:delete":
@@ -604,8 +955,8 @@ async def projects_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if data == "proj:delyes":
         name = context.user_data.get("project")
         if name:
-            delete_project(name)
-            for k in ("project", "stage_code", "await"):
+            await asyncio.to_thread(delete_project, name)
+            for k in ("project", "stage_code", "stage_name", "await"):
                 context.user_data.pop(k, None)
         await sticky_set(update, context, "✅ Inwestycję usunięto.", projects_menu_kb(context)); sync_out(uid, context); await render_home(update, context); return
 
@@ -613,6 +964,8 @@ async def projects_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await render_project(update, context); sync_out(uid, context); return
 
 # --- panel etapu ---
+@dedup_callback
+@per_user
 async def stage_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = sync_in(update, context); q = update.callback_query; await safe_answer(q); data = q.data
     proj = context.user_data.get("project")
@@ -620,7 +973,7 @@ async def stage_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if data.startswith("stage:open:"):
         scode = data.split(":")[2]
         if scode not in CODE2NAME: sync_out(uid, context); await render_project(update, context); return
-        context.user_data["stage_code"] = scode; context.user_data.pop("await", None); sync_out(uid, context)
+        set_stage(context, scode); context.user_data.pop("await", None); sync_out(uid, context)
         await render_stage(update, context); return
 
     if data == "stage:set:todo":
@@ -638,13 +991,13 @@ async def stage_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
         _, _, field, scode = data.split(":")
         sname = CODE2NAME.get(scode, "")
         if proj and sname:
-            update_stage(proj, sname, {"ToFinish" if field == "todo" else "Notes": ""}, q.from_user.first_name, q.from_user.id)
+            await asyncio.to_thread(update_stage, proj, sname, {"ToFinish" if field == "todo" else "Notes": ""}, q.from_user.first_name, q.from_user.id)
         await safe_answer(q, "Wyczyszczono ✅"); sync_out(uid, context); await render_stage(update, context); return
 
     if data.startswith("stage:save:"):
         scode = data.split(":")[2]; sname = CODE2NAME.get(scode, "")
         if proj and sname:
-            update_stage(proj, sname, {}, q.from_user.first_name, q.from_user.id)
+            await asyncio.to_thread(update_stage, proj, sname, {}, q.from_user.first_name, q.from_user.id)
         await safe_answer(q, "Zapisano ✅"); sync_out(uid, context); await render_stage(update, context); return
 
     if data == "proj:back":
@@ -655,6 +1008,8 @@ async def stage_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await render_stage(update, context); return
 
 # --- procenty ---
+@dedup_callback
+@per_user
 async def percent_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = sync_in(update, context); q = update.callback_query; await safe_answer(q)
     data = q.data
@@ -670,126 +1025,153 @@ async def percent_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         sname = CODE2NAME.get(scode, "")
         if val == "manual":
-            context.user_data["await"] = {"mode": "text", "field": "percent"}; context.user_data["stage_code"] = scode; sync_out(uid, context)
+            context.user_data["await"] = {"mode": "text", "field": "percent"}; set_stage(context, scode); sync_out(uid, context)
             await render_stage(update, context); return
         pct = None
         try: pct = int(val)
         except Exception: pass
         if proj and sname and pct is not None:
-            update_stage(proj, sname, {"Percent": pct}, q.from_user.first_name, q.from_user.id)
+            # seria kliknięć w ten sam % – zapisujemy tylko faktyczną zmianę
+            if read_stage(proj, sname)["Percent"] != pct:
+                await asyncio.to_thread(update_stage, proj, sname, {"Percent": pct}, q.from_user.first_name, q.from_user.id)
             await safe_answer(q, "Ustawiono % ✅")
         sync_out(uid, context); await render_stage(update, context); return
 
 # --- tekstowe wejścia ---
+@per_user
 async def text_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    uid = sync_in(update, context)
+    uid = sync_in(update, context); ud = context.user_data; user = update.effective_user
     txt = (update.message.text or "").strip()
-    try: await update.message.delete()
-    except Exception: pass
+    fire_and_forget(update.message.delete())
 
-    aw = context.user_data.get("await") or {}
+    aw = ud.get("await") or {}
     mode = aw.get("mode"); field = aw.get("field")
 
     if mode == "text" and field == "project_name":
-        if txt: add_project(txt)
-        context.user_data.pop("await", None); sync_out(uid, context)
+        if txt: await asyncio.to_thread(add_project, txt)
+        ud.pop("await", None); sync_out(uid, context)
         await render_home(update, context); return
 
     if mode != "text":
         sync_out(uid, context); return
 
-    proj = context.user_data.get("project")
-    scode = context.user_data.get("stage_code")
-    sname = CODE2NAME.get(scode or "", "")
+    proj = ud.get("project")
+    scode = ud.get("stage_code")
+    sname = current_stage_name(context)
     if not proj or not sname:
-        context.user_data.pop("await", None); sync_out(uid, context)
+        ud.pop("await", None); sync_out(uid, context)
         await render_home(update, context); return
 
     if field == "todo":
-        update_stage(proj, sname, {"ToFinish": txt}, update.effective_user.first_name, update.effective_user.id)
+        await asyncio.to_thread(update_stage, proj, sname, {"ToFinish": txt}, user.first_name, user.id)
     elif field == "notes":
-        update_stage(proj, sname, {"Notes": txt}, update.effective_user.first_name, update.effective_user.id)
+        await asyncio.to_thread(update_stage, proj, sname, {"Notes": txt}, user.first_name, user.id)
     elif field == "percent":
-        if not re.fullmatch(r"\d{1,3}", txt):
+        if not (1 <= len(txt) <= 3 and txt.isascii() and txt.isdigit()):
             await sticky_set(update, context, "📊 Wpisz liczbę 0-100:", percent_kb(scode)); return
         val = int(txt)
-        if not (0 <= val <= 100):
+        if val > 100:
             await sticky_set(update, context, "📊 Zakres 0-100:", percent_kb(scode)); return
-        update_stage(proj, sname, {"Percent": val}, update.effective_user.first_name, update.effective_user.id)
+        await asyncio.to_thread(update_stage, proj, sname, {"Percent": val}, user.first_name, user.id)
 
-    context.user_data.pop("await", None); sync_out(uid, context)
+    ud.pop("await", None); sync_out(uid, context)
     await render_stage(update, context)
 
 # --- zdjęcia ---
+@per_user
 async def photo_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    uid = sync_in(update, context)
-    aw = context.user_data.get("await") or {}
+    uid = sync_in(update, context); ud = context.user_data; user = update.effective_user
+    aw = ud.get("await") or {}
     if aw.get("mode") != "photo":
         sync_out(uid, context); return
-    proj = context.user_data.get("project")
-    scode = context.user_data.get("stage_code"); sname = CODE2NAME.get(scode or "", "")
+    proj = ud.get("project")
+    sname = current_stage_name(context)
     if not proj or not sname:
-        context.user_data.pop("await", None); sync_out(uid, context); return
+        ud.pop("await", None); sync_out(uid, context); return
     try:
         file_id = update.message.photo[-1].file_id
     except Exception:
-        try: await update.message.delete()
-        except Exception: pass
+        fire_and_forget(update.message.delete())
         return
-    data = read_stage(proj, sname)
-    photos = (data["Photos"] or "").split(); photos.append(file_id); photos = photos[-200:]
-    update_stage(proj, sname, {"Photos": " ".join(photos)}, update.effective_user.first_name, update.effective_user.id)
-    try: await update.message.delete()
-    except Exception: pass
-    context.user_data.pop("await", None); sync_out(uid, context)
+    await asyncio.to_thread(append_stage_photo, proj, sname, file_id, user.first_name, user.id)
+    fire_and_forget(update.message.delete())
+    ud.pop("await", None); sync_out(uid, context)
     await render_stage(update, context)
 
 # --- cancel / errors ---
+@per_user
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    try:
-        if context.user_data.get("sticky_id"):
-            await context.bot.delete_message(update.effective_chat.id, context.user_data.get("sticky_id"))
-    except Exception:
-        pass
+    ud = context.user_data; sticky_id = ud.get("sticky_id")
+    if sticky_id:
+        fire_and_forget(context.bot.delete_message(update.effective_chat.id, sticky_id))
     await update.effective_chat.send_message("Anulowano.")
-    context.user_data.clear()
+    ud.clear()
     return ConversationHandler.END
 
+# PTB zdejmuje "Bad Request: " i robi capitalize() – wystarczy porównać prefiks
+_IGNORABLE = ("Query is too old", "Query is not found")
+
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     err = context.error
-    if isinstance(err, BadRequest) and ("query is too old" in str(err).lower() or "query is not found" in str(err).lower()):
+    if isinstance(err, BadRequest) and str(err).startswith(_IGNORABLE):
         return
-    logging.exception("Unhandled exception: %s", err)
+    # traceback z context.error (jawnie, niezależnie od tego, skąd PTB woła handler)
+    log.error("Unhandled exception", exc_info=err)
+
+# --- routing callbacków ---
+# prefiks callback_data → (wzorzec, handler): jedno wyszukanie w dict + jeden match zamiast N handlerów
+CALLBACK_ROUTES = {
+    "date": ((PAT_DATE_OPEN, date_open_cb),),
+    "cal": ((PAT_CALENDAR, calendar_nav_cb),),
+    "day": ((PAT_CALENDAR, calendar_nav_cb),),
+    "nav": ((PAT_PROJECTS, projects_router),),
+    "arch": ((PAT_PROJECTS, projects_router),),
+    "proj": ((PAT_PROJECTS, projects_router), (PAT_STAGE, stage_router)),
+    "stage": ((PAT_STAGE, stage_router),),
+    "pct": ((PAT_PERCENT, percent_cb),),
+}
+
+async def route_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    data = update.callback_query.data or ""
+    for pattern, handler in CALLBACK_ROUTES.get(data.split(":", 1)[0], ()):
+        if pattern.match(data):
+            return await handler(update, context)
 
 # ──────────────────── PTB Application ────────────────────
+BOT_COMMANDS = (
+    BotCommand("start", "Otwórz panel inwestycji"),
+    BotCommand("help", "Pomoc"),
+    BotCommand("export", "Eksport do Excela"),
+)
+
 async def on_startup(app: Application) -> None:
-    await app.bot.set_my_commands([
-        BotCommand("start", "Otwórz panel inwestycji"),
-        BotCommand("help", "Pomoc"),
-    ])
+    await app.bot.set_my_commands(BOT_COMMANDS)
+
+async def on_shutdown(app: Application) -> None:
+    close_db()
 
 def build_app() -> Application:
     init_db()
-    app = ApplicationBuilder().token(TELEGRAM_TOKEN).post_init(on_startup).build()
+    app = (
+        ApplicationBuilder().token(TELEGRAM_TOKEN)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        # równoległe handlery → więcej równoległych wywołań Bot API (domyślna pula httpx to 1)
+        .connection_pool_size(64).pool_timeout(30)
+        .get_updates_pool_timeout(30)
+        .post_init(on_startup).post_shutdown(on_shutdown)
+        .build()
+    )
     app.add_handler(CommandHandler("start", start_cmd))
     app.add_handler(CommandHandler("help", help_cmd))
+    app.add_handler(CommandHandler("export", export_cmd))
     app.add_handler(CommandHandler("cancel", cancel))
 
-    # data
-    app.add_handler(CallbackQueryHandler(date_open_cb, pattern=r"^date:open$"))
-    app.add_handler(CallbackQueryHandler(calendar_nav_cb, pattern=r"^(cal:\d{4}-\d{2}|day:\d{2}\.\d{2}\.\d{4})$"))
-
-    # projekty / archiwum / usuwanie
-    app.add_handler(CallbackQueryHandler(
-        projects_router,
-        pattern=r"^(nav:home|proj:add|proj:arch|arch:tog:\d+|arch:del:\d+|arch:delyes:\d+|arch:delno|proj:open:\d+|proj:finish|proj:toggle_active|proj:delete|proj:delyes|proj:delno)$"
-    ))
-
-    # panel etapu + procenty
-    app.add_handler(CallbackQueryHandler(stage_router, pattern=r"^(stage:open:S[1-7]|stage:set:(todo|notes)|stage:set:percent:S[1-7]|stage:clear:(todo|notes):S[1-7]|stage:save:S[1-7]|proj:back|stage:add_photo)$"))
-    app.add_handler(CallbackQueryHandler(percent_cb, pattern=r"^(pct:(S[1-7]):(\d+|manual)|pct:back)$"))
+    # callbacki: data / projekty / archiwum / panel etapu / procenty
+    app.add_handler(CallbackQueryHandler(route_callback))
 
     # wejścia
+    # zapis do bazy w wątku (asyncio.to_thread); bez block=False – limit concurrent_updates obejmuje też te handlery
+    # bez filtrów po stanie: tryb (await) sprawdzają handlery pod blokadą per_user, po sync_in
     app.add_handler(MessageHandler(filters.PHOTO, photo_input))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, text_input))
 
@@ -797,19 +1179,32 @@ def build_app() -> Application:
     return app
 
 # ──────────────────── main ────────────────────
+# tylko typy, które bot obsługuje (komendy/tekst/zdjęcia + przyciski) – reszty Telegram nie wysyła
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+
 if __name__ == "__main__":
-    logging.basicConfig(level=logging.INFO, format="%(asctime)s | %(levelname)-8s | %(name)s | %(message)s")
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s | %(levelname)-8s | %(name)s | %(message)s", force=True)
     if not TELEGRAM_TOKEN:
         raise SystemExit("Brak TELEGRAM_TOKEN w env.")
-    bot_app = build_app()
-    if WEBHOOK_URL:
+    try:  # (opcjonalnie) szybsza pętla zdarzeń; bez uvloop zostaje domyślna z asyncio
+        import uvloop; uvloop.install()
+    except ImportError:
+        pass
+    if RUN_MODE == "polling":
+        bot_app = build_app()
+        # long polling: 30 s po stronie serwera, kolejne getUpdates od razu po odpowiedzi
+        bot_app.run_polling(allowed_updates=ALLOWED_UPDATES, timeout=30, poll_interval=0.0, drop_pending_updates=True)
+    else:
+        if not WEBHOOK_URL:
+            raise SystemExit("Brak WEBHOOK_URL w env (lokalnie bez webhooka ustaw RUN_MODE=polling).")
+        bot_app = build_app()
         bot_app.run_webhook(
             listen="0.0.0.0",
             port=PORT,
             url_path=TELEGRAM_TOKEN,
             webhook_url=f"{WEBHOOK_URL}/{TELEGRAM_TOKEN}",
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
             drop_pending_updates=True,
-            allowed_updates=Update.ALL_TYPES
+            allowed_updates=ALLOWED_UPDATES
         )
-    else:
-        bot_app.run_polling(allowed_updates=Update.ALL_TYPES)
\ No newline at end of file